@@ -66,6 +66,9 @@ def parseArgs(argv=None):
     parser.add_argument("--write-to", type=str, metavar="PATH",
                         help="Path to ASV db dir to write data to. %(metavar)s "
                         "is created if it does not exist.")
+    parser.add_argument("--no-threads", action="store_true",
+                        help="Write files to the --write-to db one at a time "
+                        "instead of in parallel.")
 
     return parser.parse_args(argv)
 
@@ -98,18 +101,59 @@ def openAsvdbAtPath(dbDir, repo=None, branches=None,
     return db
 
 
-def createNamespace(benchmarkInfo, benchmarkResult):
+def createNamespace(benchmarkInfo, benchmarkResult, namespace=None):
     """
     Creates a dictionary representing a namespace containing the member
     var/values on the benchmarkInfo and benchmarkResult passed in to eval/exec
     expressions in. This is usually used in place of locals() in calls to eval()
-    or exec().
+    or exec(). If namespace is given, it is cleared and reused instead of
+    creating a new dictionary, which avoids an allocation per result.
     """
-    namespace = dict(benchmarkInfo.__dict__)
-    namespace.update(benchmarkResult.__dict__)
+    if namespace is None:
+        namespace = {}
+    else:
+        namespace.clear()
+    for attr in asvdb.BenchmarkInfoKeys:
+        namespace[attr] = getattr(benchmarkInfo, attr)
+    for attr in asvdb.BenchmarkResultKeys:
+        namespace[attr] = getattr(benchmarkResult, attr)
     return namespace
 
 
+class NamespaceView(dict):
+    """
+    A namespace like the one returned by createNamespace(), except the member
+    var/values are looked up on the benchmarkInfo and benchmarkResult objs
+    when accessed instead of being copied in to a new dictionary for each
+    result. This is only suitable for read-only expressions (eg. filter and
+    print expressions), since changes to the member vars are not written back
+    to the objs.
+    """
+    __slots__ = ("benchmarkInfo", "benchmarkResult")
+
+    def __init__(self):
+        super().__init__()
+        self.benchmarkInfo = None
+        self.benchmarkResult = None
+
+    def setObjs(self, benchmarkInfo, benchmarkResult):
+        """
+        Point the view at a new pair of objs, and drop any other names that may
+        have been assigned (eg. using :=) in the previous expression.
+        """
+        self.benchmarkInfo = benchmarkInfo
+        self.benchmarkResult = benchmarkResult
+        self.clear()
+
+    def __getitem__(self, key):
+        if key in asvdb.BenchmarkInfoKeys:
+            return getattr(self.benchmarkInfo, key)
+        if key in asvdb.BenchmarkResultKeys:
+            return getattr(self.benchmarkResult, key)
+        # Raises KeyError if not found, which causes eval() to check globals
+        return super().__getitem__(key)
+
+
 def updateObjsFromNamespace(benchmarkInfo, benchmarkResult, namespace):
     """
     Update the benchmarkInfo and benchmarkResult objects passed in with the
@@ -133,11 +177,13 @@ def filterResults(resultTupleList, expr):
     the expression is applied to them.
     """
     newResultTupleList = []
+    code = compile(expr, "<filter>", "eval")
+    namespace = NamespaceView()
     for (benchmarkInfo, benchmarkResults) in resultTupleList:
         resultsForInfo = []
         for resultObj in benchmarkResults:
-            namespace = createNamespace(benchmarkInfo, resultObj)
-            if eval(expr, globals(), namespace):
+            namespace.setObjs(benchmarkInfo, resultObj)
+            if eval(code, globals(), namespace):
                 resultsForInfo.append(resultObj)
         if resultsForInfo:
             newResultTupleList.append((benchmarkInfo, resultsForInfo))
@@ -148,10 +194,12 @@ def printResults(resultTupleList, expr):
     """
     Print the print expression for each result in the resultTupleList list.
     """
+    code = compile(f"print({expr})", "<print>", "eval")
+    namespace = NamespaceView()
     for (benchmarkInfo, benchmarkResults) in resultTupleList:
         for resultObj in benchmarkResults:
-            namespace = createNamespace(benchmarkInfo, resultObj)
-            eval(f"print({expr})", globals(), namespace)
+            namespace.setObjs(benchmarkInfo, resultObj)
+            eval(code, globals(), namespace)
     return resultTupleList
 
 
@@ -160,9 +208,11 @@ def execResults(resultTupleList, code):
     Run the code on each result in the list. This likely results in modified
     objects and possibly new variables in the global namespace.
     """
+    code = compile(code, "<exec>", "exec")
+    namespace = {}
     for (benchmarkInfo, benchmarkResults) in resultTupleList:
         for resultObj in benchmarkResults:
-            namespace = createNamespace(benchmarkInfo, resultObj)
+            createNamespace(benchmarkInfo, resultObj, namespace)
             exec(code, globals(), namespace)
             updateObjsFromNamespace(benchmarkInfo, resultObj, namespace)
     return resultTupleList
@@ -181,8 +231,7 @@ def updateDb(dbObj, resultTupleList):
     """
     Write the results to the dbOj.
     """
-    for (benchmarkInfo, benchmarkResults) in resultTupleList:
-        dbObj.addResults(benchmarkInfo, benchmarkResults)
+    dbObj.addResultTuples(resultTupleList)
 
 
 def main():
@@ -217,6 +266,8 @@ def main():
                                    branches=fromDb.branches,
                                    projectName=fromDb.projectName,
                                    commitUrl=fromDb.commitUrl)
+            if args.no_threads:
+                toDb.writeThreads = 1
             updateDb(toDb, results)
 
 
@@ -1,12 +1,26 @@
 import json
+import math
 import os
 from os import path
 from pathlib import Path
 import itertools
-import glob
 import time
 import random
 import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only lockfiles are used for locking.
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BenchmarkInfoKeys = set([
     "machineName",
@@ -32,10 +46,83 @@ BenchmarkResultKeys = set([
 ])
 
 
+def _loadJson(data):
+    """
+    Return a tuple containing the object represented by the JSON bytes in
+    data, using orjson if available, and True if it may contain NaN or
+    infinite floats that orjson would not write back the same way (see
+    _dumpJson()).
+    """
+    if orjson is not None:
+        try:
+            return (orjson.loads(data), False)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json (eg. it does not accept NaN), so
+            # give json a chance to read files it may have written.
+            return (json.loads(data), True)
+    return (json.loads(data), False)
+
+
+def _dumpJson(obj, compact=False, nonFinite=False):
+    """
+    Return obj serialized as JSON bytes with a trailing newline, using orjson
+    if available. The JSON is indented unless compact is True.
+
+    orjson writes NaN and inf as null, which would read back as None, so
+    nonFinite must be True if obj may contain them. json is then used to
+    write them as NaN and Infinity, the same as without orjson installed.
+    """
+    if (orjson is not None) and not(nonFinite):
+        option = orjson.OPT_APPEND_NEWLINE
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:
+            # orjson does not serialize some types json does (eg. subclasses of
+            # float other than those from numpy).
+            pass
+    if compact:
+        return (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+    return (json.dumps(obj, indent=2) + "\n").encode()
+
+
+# Per-dir locks shared by all ASVDb instances in this process, see
+# _getDirWriteLock().
+_dirWriteLocks = {}
+_dirWriteLocksLock = threading.Lock()
+
+
+def _getDirWriteLock(dirPath):
+    """
+    Return the threading.Lock used by all ASVDb instances in this process to
+    write to the db at dirPath. Taking it before the file lock means writers in
+    the same process wait on each other without polling for lockfiles.
+    """
+    realDirPath = path.realpath(dirPath)
+    with _dirWriteLocksLock:
+        return _dirWriteLocks.setdefault(realDirPath, threading.Lock())
+
+
+@lru_cache(maxsize=256)
+def _getResultsFileName(commitHash, pythonVer, cudaVer, osType):
+    """
+    Return the name of the results file for the benchmarkInfo fields passed
+    in. Most results added in a session share these, so names are cached.
+    """
+    return f"{commitHash}-python{pythonVer}-cuda{cudaVer}-{osType}.json"
+
+
 class BenchmarkInfo:
     """
     Meta-data describing the environment for a benchmark or set of benchmarks.
     """
+    # These objs are created in bulk when reading a db, so use __slots__ to
+    # keep them small. This must match BenchmarkInfoKeys.
+    __slots__ = ("machineName", "cudaVer", "osType", "pythonVer", "commitHash",
+                 "commitTime", "branch", "gpuType", "cpuType", "arch", "ram",
+                 "gpuRam", "requirements")
+
     def __init__(self, machineName="", cudaVer="", osType="", pythonVer="",
                  commitHash="", commitTime=0, branch="",
                  gpuType="", cpuType="", arch="", ram="", gpuRam="",
@@ -93,6 +180,10 @@ class BenchmarkResult:
     The result of a benchmark run for a particular benchmark function, given
     specific args.
     """
+    # These objs are created in bulk when reading a db, so use __slots__ to
+    # keep them small. This must match BenchmarkResultKeys.
+    __slots__ = ("funcName", "result", "argNameValuePairs", "unit")
+
     def __init__(self, funcName, result, argNameValuePairs=None, unit=None):
         self.funcName = funcName
         self.argNameValuePairs = self.__sanitizeArgNameValues(argNameValuePairs)
@@ -103,7 +194,9 @@ class BenchmarkResult:
     def __sanitizeArgNameValues(self, argNameValuePairs):
         if argNameValuePairs is None:
             return []
-        return [(n, str(v if v is not None else "NaN")) for (n, v) in argNameValuePairs]
+        # Values are often already strs, so skip the str() call for those.
+        return [(n, v) if type(v) is str else (n, "NaN" if v is None else str(v))
+                for (n, v) in argNameValuePairs]
 
 
     def __repr__(self):
@@ -121,6 +214,18 @@ class BenchmarkResult:
             and (self.unit == other.unit)
 
 
+class _WithBlockState(threading.local):
+    """
+    The "with" blocks of an ASVDb obj being executed by the current thread,
+    and the results added inside them.
+    """
+    def __init__(self):
+        self.queuedResultTuples = []
+        # Length of queuedResultTuples when each block was entered, outermost
+        # first, so a block that raises can discard only the results it added.
+        self.queueLens = []
+
+
 class ASVDb:
     """
     A "database" of benchmark results consumable by ASV.
@@ -133,9 +238,11 @@ class ASVDb:
     benchmarksFileName = "benchmarks.json"
     machineFileName = "machine.json"
     lockfilePrefix = ".asvdbLOCK"
+    flockFileName = ".asvdbFLOCK"
 
     def __init__(self, dbDir,
-                 repo=None, branches=None, projectName=None, commitUrl=None):
+                 repo=None, branches=None, projectName=None, commitUrl=None,
+                 autoFlush=True):
         """
         dbDir - directory containing the ASV results, config file, etc.
         repo - the repo associated with all reasults in the DB.
@@ -144,12 +251,16 @@ class ASVDb:
         commitUrl - the URL ASV will use in reports to redirect users to when
                     they click on a data point. This is typically a Github
                     project URL that shows the contents of a commit.
+        autoFlush - if False, results are not written when added but are
+                    queued until flush() is called, as if always inside a
+                    "with" block.
         """
         self.dbDir = dbDir
         self.repo = repo
         self.branches = branches
         self.projectName = projectName
         self.commitUrl = commitUrl
+        self.autoFlush = autoFlush
 
         self.confFilePath = path.join(self.dbDir, self.confFileName)
         self.confVersion = self.defaultConfVersion
@@ -162,6 +273,62 @@ class ASVDb:
         # instances that may be setting locks.
         self.lockfileName = "%s-%s-%s" % (self.lockfilePrefix, os.getpid(), time.time())
         self.lockfileTimeout = 5  # seconds
+        # Lock using flock() if possible (see __getLock()). Writers also take a
+        # lockfile, so they exclude writers on other machines even where
+        # flock() only locks against processes on the same machine (eg. some
+        # NFS mounts). Set to False to only use lockfiles.
+        self.useFlock = fcntl is not None
+        # The lock above is between ASVDb instances. This lock is held with it
+        # so threads sharing this instance do not use the cached files (or the
+        # flock fd) at the same time.
+        self._threadLock = threading.RLock()
+        # See _getDirWriteLock(). Set on first use since dbDir may not exist
+        # yet.
+        self._dirWriteLock = None
+        self._holdingDirWriteLock = False
+        # File descriptor of the flock file while the lock is held using
+        # flock(), None otherwise.
+        self._flockFd = None
+        # True while this instance may have a lockfile in place.
+        self._holdingLockfile = False
+        # Files are written to a temp file with this suffix and renamed into
+        # place. Like the lockfile name, it is unique to this instance.
+        self.tmpfileSuffix = ".tmp-%s-%s" % (os.getpid(), time.time())
+        # Max number of threads used to write files in parallel when several
+        # files need to be written at once. 1 writes files serially.
+        self.writeThreads = 4
+
+        # Parsed JSON files keyed by path, kept between locked operations.
+        # Other ASVDb instances are free to modify the files while the lock is
+        # not held, so a cached dict is only used if the file's stat key (see
+        # __getStatKey()) still matches the one recorded in _jsonCacheStatKeys
+        # when it was read or written. Files are only checked once per locked
+        # operation, and those checked are in _checkedJsonFiles. The stat key
+        # of a file that does not exist is None.
+        self._jsonCache = {}
+        self._jsonCacheStatKeys = {}
+        self._checkedJsonFiles = set()
+        # Paths in self._jsonCache that have been updated but not yet written,
+        # mapped to True if the file is to be written as compact JSON.
+        self._dirtyJsonFiles = {}
+        # Paths in self._jsonCache that may contain NaN or infinite floats,
+        # see _dumpJson().
+        self._nonFiniteJsonFiles = set()
+        # Per-benchmark list of sets of the values for each param in the cached
+        # benchmarks.json, for fast membership checks. Never written to disk.
+        self._benchmarkParamSets = {}
+        # Dirs known to exist, so they need not be checked before every write.
+        self._existingDirs = set()
+        # Per-results file dict of benchmark name to a (dict mapping each tuple
+        # of param values to a result, list of sets of param values) tuple.
+        # See __getParamsResultMap().
+        self._paramsResultMaps = {}
+        # Results added with autoFlush False, or inside "with" blocks that have
+        # exited, written by flush().
+        self._queuedResultTuples = []
+        # "with" blocks are per-thread, so results added by other threads
+        # sharing this instance are neither deferred nor discarded by them.
+        self._withBlockState = _WithBlockState()
 
         ########################################
         # Testing and debug members
@@ -171,6 +338,37 @@ class ASVDb:
         self.writeDelay = 0
         # To "cancel" write operations that are being delayed.
         self.cancelWrite = False
+        # threading.Events to deterministically test write collisions: if set,
+        # writeLockedEvent is set once the lock is held for a write, and the
+        # write then waits for writeContinueEvent to be set.
+        self.writeLockedEvent = None
+        self.writeContinueEvent = None
+
+
+    def __enter__(self):
+        """
+        Defer writing results added inside the "with" block until the block
+        exits, so all of them are written by a single locked operation.  Only
+        results added by the thread executing the block are deferred.
+        """
+        state = self._withBlockState
+        state.queueLens.append(len(state.queuedResultTuples))
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        state = self._withBlockState
+        queueLen = state.queueLens.pop()
+        if excType is not None:
+            # Like a DB transaction, nothing added in a failed block is
+            # written, even if it is nested in a block that succeeds.
+            del state.queuedResultTuples[queueLen:]
+        elif not(state.queueLens):
+            with self._threadLock:
+                self._queuedResultTuples += state.queuedResultTuples
+                state.queuedResultTuples = []
+                self.flush()
+        return False
 
 
     ###########################################################################
@@ -183,7 +381,7 @@ class ASVDb:
         """
         self.__assertDbDirExists()
         try:
-            self.__getLock(self.dbDir)
+            self.__getLock(self.dbDir, shared=True)
             # FIXME: check if confFile exists
             d = self.__loadJsonDictFromFile(self.confFilePath)
             self.resultsDirName = d.get("results_dir", self.resultsDirName)
@@ -191,7 +389,9 @@ class ASVDb:
             self.benchmarksFilePath = path.join(self.resultsDirPath, self.benchmarksFileName)
             self.htmlDirName = d.get("html_dir", self.htmlDirName)
             self.repo = d.get("repo")
-            self.branches = d.get("branches", [])
+            # Copy the list, since d is cached and self.branches is appended
+            # to when results for new branches are added.
+            self.branches = list(d.get("branches", []))
             self.projectName = d.get("project")
             self.commitUrl = d.get("show_commit_url")
 
@@ -210,6 +410,11 @@ class ASVDb:
             self.__getLock(self.dbDir)
             if self.__waitForWrite():
                 self.__updateConfFile()
+                self.__flushJsonFiles()
+        except BaseException:
+            # The cached dicts may have been updated but not written.
+            self.__clearJsonCache()
+            raise
         finally:
             self.__releaseLock(self.dbDir)
 
@@ -220,14 +425,7 @@ class ASVDb:
         This will also update the conf file with the CTOR args if not done
         already.
         """
-        self.__ensureDbDirExists()
-        try:
-            self.__getLock(self.dbDir)
-            if self.__waitForWrite():
-                self.__updateFilesForInfo(benchmarkInfo)
-                self.__updateFilesForResult(benchmarkInfo, benchmarkResult)
-        finally:
-            self.__releaseLock(self.dbDir)
+        self.addResultTuples([(benchmarkInfo, [benchmarkResult])])
 
 
     def addResults(self, benchmarkInfo, benchmarkResultList):
@@ -236,15 +434,43 @@ class ASVDb:
         benchmarkInfo to the DB.  This will also update the conf file with the
         CTOR args if not done already.
         """
-        self.__ensureDbDirExists()
-        try:
-            self.__getLock(self.dbDir)
-            if self.__waitForWrite():
-                self.__updateFilesForInfo(benchmarkInfo)
-                for resultObj in benchmarkResultList:
-                    self.__updateFilesForResult(benchmarkInfo, resultObj)
-        finally:
-            self.__releaseLock(self.dbDir)
+        self.addResultTuples([(benchmarkInfo, benchmarkResultList)])
+
+
+    def addResultTuples(self, resultTupleList):
+        """
+        Add the results in resultTupleList, a list of (BenchmarkInfo obj,
+        [BenchmarkResult obj, ...]) tuples as returned by getResults(), to the
+        DB. The lock is only taken once and each affected file is only written
+        once, regardless of the number of results.  This will also update the
+        conf file with the CTOR args if not done already.
+
+        Inside a "with" block, or if autoFlush is False, the results are
+        queued and written by flush().
+        """
+        state = self._withBlockState
+        with self._threadLock:
+            if state.queueLens or not(self.autoFlush):
+                queue = state.queuedResultTuples if state.queueLens \
+                    else self._queuedResultTuples
+                queue += [(benchmarkInfo, list(benchmarkResultList))
+                          for (benchmarkInfo, benchmarkResultList)
+                          in resultTupleList]
+                return
+            self.__addResultTuples(resultTupleList)
+
+
+    def flush(self):
+        """
+        Write all queued results to the DB. This is done automatically when a
+        "with" block exits. Results added inside "with" blocks that have not
+        exited yet are not written.
+        """
+        with self._threadLock:
+            resultTupleList = self._queuedResultTuples
+            self._queuedResultTuples = []
+            if resultTupleList:
+                self.__addResultTuples(resultTupleList)
 
 
     def getInfo(self):
@@ -253,7 +479,7 @@ class ASVDb:
         """
         self.__assertDbDirExists()
         try:
-            self.__getLock(self.dbDir)
+            self.__getLock(self.dbDir, shared=True)
             retList = self.__readResults(infoOnly=True)
         finally:
             self.__releaseLock(self.dbDir)
@@ -270,7 +496,7 @@ class ASVDb:
         """
         self.__assertDbDirExists()
         try:
-            self.__getLock(self.dbDir)
+            self.__getLock(self.dbDir, shared=True)
             retList = self.__readResults(filterByInfoObjs=filterInfoObjList)
         finally:
             self.__releaseLock(self.dbDir)
@@ -332,9 +558,15 @@ class ASVDb:
                 # (BenchmarkInfo, [BenchmarkResult objs, ...]) based on infoOnly
                 machineResults = []
                 for resultsFile in machineDir.iterdir():
-                    if resultsFile == machineJsonFile:
+                    # Skip anything that isn't a results file, such as temp
+                    # files left behind by a writer that died.
+                    if (resultsFile == machineJsonFile) \
+                       or (resultsFile.suffix != ".json"):
                         continue
-                    rDict = self.__loadJsonDictFromFile(resultsFile.as_posix())
+                    # Results files are typically only read once, so don't
+                    # fill the cache with every one of them.
+                    rDict = self.__loadJsonDictFromFile(resultsFile.as_posix(),
+                                                        cache=False)
 
                     resultsParams = rDict.get("params", {})
                     # Each results file has a single BenchmarkInfo obj
@@ -352,7 +584,9 @@ class ASVDb:
                         arch=mDict.get("arch", ""),
                         ram=mDict.get("ram", ""),
                         gpuRam=mDict.get("gpuRam", ""),
-                        requirements=rDict.get("requirements", {})
+                        # rDict is cached, so do not share its dicts with
+                        # objs returned to the caller.
+                        requirements=dict(rDict.get("requirements", {}))
                     )
 
                     # If a filter was specified, at least one EXACT MATCH to the
@@ -406,6 +640,28 @@ class ASVDb:
         return retList
 
 
+    def __addResultTuples(self, resultTupleList):
+        """
+        Add the results in resultTupleList to the DB files, taking the lock
+        once for all of them.
+        """
+        self.__ensureDbDirExists()
+        try:
+            self.__getLock(self.dbDir)
+            if self.__waitForWrite():
+                for (benchmarkInfo, benchmarkResultList) in resultTupleList:
+                    self.__updateFilesForInfo(benchmarkInfo)
+                    self.__updateFilesForResults(benchmarkInfo,
+                                                 benchmarkResultList)
+                self.__flushJsonFiles()
+        except BaseException:
+            # The cached dicts may have been updated but not written.
+            self.__clearJsonCache()
+            raise
+        finally:
+            self.__releaseLock(self.dbDir)
+
+
     def __updateFilesForInfo(self, benchmarkInfo):
         """
         Updates all the db files that are affected by a new BenchmarkInfo obj.
@@ -426,16 +682,17 @@ class ASVDb:
         self.__updateMachineJson(benchmarkInfo)
 
 
-    def __updateFilesForResult(self, benchmarkInfo, benchmarkResult):
+    def __updateFilesForResults(self, benchmarkInfo, benchmarkResultList):
         """
-        Updates all the db files that are affected by a new BenchmarkResult
-        obj. This also requires the corresponding BenchmarkInfo obj since some
-        results files also include info data.
+        Updates all the db files that are affected by the new BenchmarkResult
+        objs in benchmarkResultList. This also requires the corresponding
+        BenchmarkInfo obj since some results files also include info data.
         """
         # <self.dbDir>/results/benchmarks.json
-        self.__updateBenchmarkJson(benchmarkResult)
+        for benchmarkResult in benchmarkResultList:
+            self.__updateBenchmarkJson(benchmarkResult)
         # <self.dbDir>/results/<machine dir>/<result file name>.json
-        self.__updateResultJson(benchmarkResult, benchmarkInfo)
+        self.__updateResultJson(benchmarkResultList, benchmarkInfo)
 
 
     def __assertDbDirExists(self):
@@ -446,7 +703,12 @@ class ASVDb:
 
     def __ensureDbDirExists(self):
         if not(path.exists(self.dbDir)):
-            os.mkdir(self.dbDir)
+            # This is called before the lock is taken, so another ASVDb
+            # instance may be creating the dir at the same time.
+            try:
+                os.mkdir(self.dbDir)
+            except FileExistsError:
+                return
             # Hack: os.mkdir() seems to return before the filesystem catches up,
             # so pause before returning to help ensure the dir actually exists
             time.sleep(0.1)
@@ -460,11 +722,14 @@ class ASVDb:
             raise AttributeError("repo must be set to non-None before "
                                  f"writing {self.confFilePath}")
 
-        d = self.__loadJsonDictFromFile(self.confFilePath)
+        # Update a copy so the cached dict can be compared to it below.
+        origD = self.__loadJsonDictFromFile(self.confFilePath)
+        d = dict(origD)
         # ASVDb is git-only for now, so ensure .git extension
         d["repo"] = self.repo + (".git" if not self.repo.endswith(".git") else "")
         currentBranches = d.get("branches", [])
-        d["branches"] = currentBranches + [b for b in (self.branches or []) if b not in currentBranches]
+        # Append new branches, dropping duplicates but keeping the order
+        d["branches"] = list(dict.fromkeys(currentBranches + list(self.branches or [])))
         d["version"] = self.confVersion
         d["project"] = self.projectName or self.repo.replace(".git", "").split("/")[-1]
         d["show_commit_url"] = self.commitUrl or \
@@ -472,7 +737,10 @@ class ASVDb:
                                 + ("/" if not self.repo.endswith("/") else "") \
                                 + "commit/")
 
-        self.__writeJsonDictToFile(d, self.confFilePath)
+        # This is called every time results are added, but the conf file
+        # rarely changes after the db is created.
+        if d != origD:
+            self.__writeJsonDictToFile(d, self.confFilePath)
 
 
 
@@ -505,18 +773,25 @@ class ASVDb:
         #     }
         # }
 
-        newParamNames = []
-        newParamValues = []
-        for (n, v) in benchmarkResult.argNameValuePairs:
-            newParamNames.append(n)
-            newParamValues.append(v)
+        argNameValuePairs = benchmarkResult.argNameValuePairs
+        newParamNames = [n for (n, _) in argNameValuePairs]
+        newParamValues = [v for (_, v) in argNameValuePairs]
 
         d = self.__loadJsonDictFromFile(self.benchmarksFilePath)
 
-        benchDict = d.setdefault(benchmarkResult.funcName,
-                                 self.__getDefaultBenchmarkDescrDict(
-                                     benchmarkResult.funcName, newParamNames))
-        benchDict["unit"] = benchmarkResult.unit
+        # Most results are for benchmarks and param values that are already
+        # present, so track if anything changed to avoid needlessly rewriting
+        # the file (which contains every benchmark in the db).
+        changed = (benchmarkResult.funcName not in d) or (d.get("version") != 2)
+
+        benchDict = d.get(benchmarkResult.funcName)
+        if benchDict is None:
+            benchDict = self.__getDefaultBenchmarkDescrDict(
+                benchmarkResult.funcName, newParamNames)
+            d[benchmarkResult.funcName] = benchDict
+        if benchDict.get("unit") != benchmarkResult.unit:
+            benchDict["unit"] = benchmarkResult.unit
+            changed = True
 
         existingParamNames = benchDict["param_names"]
         existingParamValues = benchDict["params"]
@@ -534,22 +809,31 @@ class ASVDb:
                                 numNewParams))
         numParams = numNewParams
 
-        cartProd = list(itertools.product(*existingParamValues))
-        if tuple(newParamValues) not in cartProd:
-            if numExistingParamValues == 0:
-                for newVal in newParamValues:
-                    existingParamValues.append([newVal])
-            else:
-                for i in range(numParams):
-                    if newParamValues[i] not in existingParamValues[i]:
-                        existingParamValues[i].append(newParamValues[i])
+        # The new param values are already present if each value is present in
+        # the list of values for its param, so there's no need to check against
+        # the (potentially huge) cartesian product of all param values.
+        paramValueSets = self._benchmarkParamSets.get(benchmarkResult.funcName)
+        if paramValueSets is None:
+            paramValueSets = [set(vals) for vals in existingParamValues]
+            self._benchmarkParamSets[benchmarkResult.funcName] = paramValueSets
 
-        d[benchmarkResult.funcName] = benchDict
+        if numExistingParamValues == 0:
+            for newVal in newParamValues:
+                existingParamValues.append([newVal])
+                paramValueSets.append({newVal})
+                changed = True
+        else:
+            for i in range(numParams):
+                if newParamValues[i] not in paramValueSets[i]:
+                    existingParamValues[i].append(newParamValues[i])
+                    paramValueSets[i].add(newParamValues[i])
+                    changed = True
 
         # a version key must always be present in self.benchmarksFilePath,
         # "current" ASV version requires this to be 2 (or higher?)
         d["version"] = 2
-        self.__writeJsonDictToFile(d, self.benchmarksFilePath)
+        if changed:
+            self.__writeJsonDictToFile(d, self.benchmarksFilePath)
 
 
     def __updateMachineJson(self, benchmarkInfo):
@@ -568,6 +852,7 @@ class ASVDb:
                                     benchmarkInfo.machineName,
                                     self.machineFileName)
         d = self.__loadJsonDictFromFile(machineFilePath)
+        origD = dict(d)
         d["arch"] = benchmarkInfo.arch
         d["cpu"] = benchmarkInfo.cpuType
         d["gpu"] = benchmarkInfo.gpuType
@@ -577,10 +862,13 @@ class ASVDb:
         d["ram"] = benchmarkInfo.ram
         d["gpuRam"] = benchmarkInfo.gpuRam
         d["version"] = 1
-        self.__writeJsonDictToFile(d, machineFilePath)
+        # Results are typically added for the same machine over and over, so
+        # only write the file if something actually changed.
+        if d != origD:
+            self.__writeJsonDictToFile(d, machineFilePath)
 
 
-    def __updateResultJson(self, benchmarkResult, benchmarkInfo):
+    def __updateResultJson(self, benchmarkResultList, benchmarkInfo):
         # The following is an example of the schema ASV expects for
         # '<machine>-<commit_hash>.json'. If param names are A, B, and C
         #
@@ -618,6 +906,12 @@ class ASVDb:
         #     "version": 1,
         # }
 
+        # Nothing to do (and no results file to create) if there are no results
+        if not benchmarkResultList:
+            return
+
+        # All results share the same benchmarkInfo, so the results file and
+        # the info data in it only need to be updated once for all of them.
         resultsFilePath = self.__getResultsFilePath(benchmarkInfo)
         d = self.__loadJsonDictFromFile(resultsFilePath)
         d["params"] = {"gpu": benchmarkInfo.gpuType,
@@ -626,66 +920,98 @@ class ASVDb:
                        "os": benchmarkInfo.osType,
                        "python": benchmarkInfo.pythonVer,
                        }
-        d["requirements"] = benchmarkInfo.requirements
+        d["requirements"] = dict(benchmarkInfo.requirements)
 
         allResultsDict = d.setdefault("results", {})
-        resultDict = allResultsDict.setdefault(benchmarkResult.funcName, {})
 
-        existingParamValuesList = resultDict.setdefault("params", [])
-        existingResultValueList = resultDict.setdefault("result", [])
+        d["commit_hash"] = benchmarkInfo.commitHash
+        d["branch"] = benchmarkInfo.branch
+        d["date"] = int(benchmarkInfo.commitTime)
+        d["python"] = benchmarkInfo.pythonVer
+        d["version"] = 1
 
-        # FIXME: dont assume these are ordered properly (ie. the same way as
-        # defined in benchmarks.json)
-        newResultParamValues = tuple(v for (_, v) in benchmarkResult.argNameValuePairs)
+        for benchmarkResult in benchmarkResultList:
+            resultDict = allResultsDict.setdefault(benchmarkResult.funcName, {})
 
-        # Update the "params" lists with the new param settings for the new result.
-        # Only add values that are not already present
-        numExistingParamValues = len(existingParamValuesList)
-        if numExistingParamValues == 0:
-            for newParamValue in newResultParamValues:
-                existingParamValuesList.append([newParamValue])
-            results = [benchmarkResult.result]
+            existingParamValuesList = resultDict.setdefault("params", [])
+            (paramsResultMap, paramValueSets) = self.__getParamsResultMap(
+                resultsFilePath, benchmarkResult.funcName, resultDict)
 
-        else:
-            for i in range(numExistingParamValues):
-                if newResultParamValues[i] not in existingParamValuesList[i]:
-                    existingParamValuesList[i].append(newResultParamValues[i])
-
-            # ASV uses the cartesian product of the param values for looking up
-            # the result for a particular combination of param values.  For
-            # example: "params": [["a"], ["b", "c"], ["d", "e"]] results in:
-            # [("a", "b", "d"), ("a", "b", "e"), ("a", "c", "d"), ("a", "c",
-            # "e")] and each combination of param values has a result, with the
-            # results for the corresponding param values in the same order.  If
-            # a result for a set of param values DNE, use None.
-
-            # store existing results in map based on cartesian product of all
-            # current params.
-            paramsCartProd = list(itertools.product(*existingParamValuesList))
-            # Assume there is an equal number of results for cartProd values
-            # (some will be None)
-            paramsResultMap = dict(zip(paramsCartProd, existingResultValueList))
+            # FIXME: dont assume these are ordered properly (ie. the same way
+            # as defined in benchmarks.json)
+            newResultParamValues = tuple(v for (_, v) in benchmarkResult.argNameValuePairs)
 
-            # Add the new result
-            paramsResultMap[newResultParamValues] = benchmarkResult.result
+            # Update the "params" lists with the new param settings for the new
+            # result.  Only add values that are not already present
+            numExistingParamValues = len(existingParamValuesList)
+            if numExistingParamValues == 0:
+                for newParamValue in newResultParamValues:
+                    existingParamValuesList.append([newParamValue])
+                    paramValueSets.append({newParamValue})
+            else:
+                for i in range(numExistingParamValues):
+                    if newResultParamValues[i] not in paramValueSets[i]:
+                        existingParamValuesList[i].append(newResultParamValues[i])
+                        paramValueSets[i].add(newResultParamValues[i])
 
-            # Re-compute the cartesian product of all param values now that the
-            # new values are added. Use this to determine where to place the new
-            # result in the result list.
-            results = []
-            for paramVals in itertools.product(*existingParamValuesList):
-                results.append(paramsResultMap.get(paramVals))
+            # Add the new result. The "result" list is updated from
+            # paramsResultMap when the file is written.
+            result = benchmarkResult.result
+            paramsResultMap[newResultParamValues] = result
+            if isinstance(result, float) and not(math.isfinite(result)):
+                self._nonFiniteJsonFiles.add(resultsFilePath)
 
-        resultDict["params"] = existingParamValuesList
-        resultDict["result"] = results
+        # Like ASV, write results files (by far the largest) without
+        # indentation, which makes them much smaller and faster to write.
+        self.__writeJsonDictToFile(d, resultsFilePath, compact=True)
+
+
+    def __getParamsResultMap(self, resultsFilePath, funcName, resultDict):
+        """
+        Return a tuple containing the dictionary mapping each tuple of param
+        values to its result for the funcName benchmark in the results file,
+        and a list of sets of the values for each param (for fast membership
+        checks), creating them from resultDict (the benchmark's entry in the
+        file) if necessary.
+
+        ASV uses the cartesian product of the param values for looking up the
+        result for a particular combination of param values.  For example:
+        "params": [["a"], ["b", "c"], ["d", "e"]] results in: [("a", "b", "d"),
+        ("a", "b", "e"), ("a", "c", "d"), ("a", "c", "e")] and each combination
+        of param values has a result, with the results for the corresponding
+        param values in the same order.  Adding a new param value changes the
+        position of existing results in the list, so results are added to this
+        map instead and the list is only re-created once, when the file is
+        written (see __updateResultLists()).
+        """
+        paramsResultMaps = self._paramsResultMaps.setdefault(resultsFilePath, {})
+        mapAndSets = paramsResultMaps.get(funcName)
+        if mapAndSets is None:
+            paramValues = resultDict.get("params", [])
+            # Assume there is an equal number of results for cartProd values
+            # (some will be None)
+            paramsCartProd = itertools.product(*paramValues)
+            paramsResultMap = dict(zip(paramsCartProd,
+                                       resultDict.get("result", [])))
+            paramValueSets = [set(vals) for vals in paramValues]
+            mapAndSets = (paramsResultMap, paramValueSets)
+            paramsResultMaps[funcName] = mapAndSets
+        return mapAndSets
 
-        d["commit_hash"] = benchmarkInfo.commitHash
-        d["branch"] = benchmarkInfo.branch
-        d["date"] = int(benchmarkInfo.commitTime)
-        d["python"] = benchmarkInfo.pythonVer
-        d["version"] = 1
 
-        self.__writeJsonDictToFile(d, resultsFilePath)
+    def __updateResultLists(self):
+        """
+        Re-create the "result" list in each cached results file from the
+        params/result maps created by __getParamsResultMap().  If a result for
+        a set of param values DNE, use None.
+        """
+        for (resultsFilePath, paramsResultMaps) in self._paramsResultMaps.items():
+            allResultsDict = self._jsonCache[resultsFilePath]["results"]
+            for (funcName, (paramsResultMap, _)) in paramsResultMaps.items():
+                resultDict = allResultsDict[funcName]
+                resultDict["result"] = \
+                    [paramsResultMap.get(paramVals) for paramVals in
+                     itertools.product(*resultDict["params"])]
 
 
     def __getDefaultBenchmarkDescrDict(self, funcName, paramNames):
@@ -703,53 +1029,206 @@ class ASVDb:
     def __getResultsFilePath(self, benchmarkInfo):
         # The path to the resultsFile will be based on additional params present
         # in the benchmarkInfo obj.
-        fileNameParts = [benchmarkInfo.commitHash,
-                         "python%s" % benchmarkInfo.pythonVer,
-                         "cuda%s" % benchmarkInfo.cudaVer,
-                         benchmarkInfo.osType,
-                        ]
-        fileName = "-".join(fileNameParts) + ".json"
+        fileName = _getResultsFileName(benchmarkInfo.commitHash,
+                                       benchmarkInfo.pythonVer,
+                                       benchmarkInfo.cudaVer,
+                                       benchmarkInfo.osType)
         return path.join(self.resultsDirPath,
                          benchmarkInfo.machineName,
                          fileName)
 
 
-    def __loadJsonDictFromFile(self, jsonFile):
+    def __loadJsonDictFromFile(self, jsonFile, cache=True):
         """
         Return a dictionary representing the contents of jsonFile by
         either reading in the existing file or returning {}
+
+        The dictionary is cached, so repeated calls for the same file (eg. once
+        per result in addResults(), or once per addResult() call) only read and
+        parse it again if it was modified by someone else. If cache is False,
+        a file that is not already cached is not added to the cache (used for
+        files that are only read once).
         """
-        if path.exists(jsonFile):
-            with open(jsonFile) as fobj:
-                # FIXME: ideally this could use flock(), but some situations do
-                # not allow grabbing a file lock (NFS?)
-                # fcntl.flock(fobj, fcntl.LOCK_EX)
-                # FIXME: error checking
-                return json.load(fobj)
+        if jsonFile in self._checkedJsonFiles:
+            return self._jsonCache[jsonFile]
+
+        d = {}
+        statKey = None
+        # The file is opened even if it is cached, since on NFS open()
+        # revalidates with the server while stat() on a path may return
+        # attributes cached from before another host replaced the file.  No
+        # file lock is needed to read: files are only ever replaced whole by a
+        # rename (see __flushJsonFiles()), so the file read is always complete.
+        # The stat key is taken from the open file so it matches the contents
+        # read even if the file is replaced meanwhile.
+        try:
+            with open(jsonFile, "rb") as fobj:
+                statKey = self.__getStatKey(fobj.fileno())
+                if (jsonFile in self._jsonCache) and \
+                   (self._jsonCacheStatKeys[jsonFile] == statKey):
+                    d = self._jsonCache[jsonFile]
+                    nonFinite = jsonFile in self._nonFiniteJsonFiles
+                else:
+                    # FIXME: error checking
+                    (d, nonFinite) = _loadJson(fobj.read())
+        except FileNotFoundError:
+            nonFinite = False
+        if not(cache) and (jsonFile not in self._jsonCache):
+            return d
+
+        if nonFinite:
+            self._nonFiniteJsonFiles.add(jsonFile)
+        else:
+            self._nonFiniteJsonFiles.discard(jsonFile)
+        self._jsonCache[jsonFile] = d
+        self._jsonCacheStatKeys[jsonFile] = statKey
+        self._checkedJsonFiles.add(jsonFile)
+        return d
 
-        return {}
+
+    def __writeJsonDictToFile(self, jsonDict, filePath, compact=False):
+        """
+        Update the cached contents of filePath with jsonDict. The file itself
+        is written by the next call to __flushJsonFiles(), so a file updated
+        many times during a single locked operation is only written once.
+        If compact is True, the file is written without indentation.
+        """
+        self._jsonCache[filePath] = jsonDict
+        self._checkedJsonFiles.add(filePath)
+        self._dirtyJsonFiles[filePath] = compact
+
+
+    def __flushJsonFiles(self):
+        """
+        Write all files updated by __writeJsonDictToFile() to disk.
+        """
+        self.__updateResultLists()
+
+        filePaths = sorted(self._dirtyJsonFiles)
+        # Create any missing dirs up front so the writes below can be done in
+        # parallel.
+        for filePath in filePaths:
+            dirPath = path.dirname(filePath)
+            if dirPath not in self._existingDirs:
+                os.makedirs(dirPath, exist_ok=True)
+                self._existingDirs.add(dirPath)
+
+        # Each file is written by at most one thread, and the dicts are not
+        # modified while writing, so no additional locking is needed.
+        numThreads = min(self.writeThreads, len(filePaths))
+        if numThreads > 1:
+            with ThreadPoolExecutor(max_workers=numThreads) as executor:
+                # Consume the results to re-raise any exception from a write
+                list(executor.map(self.__writeJsonFile, filePaths))
+        else:
+            for filePath in filePaths:
+                self.__writeJsonFile(filePath)
+
+        self._dirtyJsonFiles.clear()
 
 
-    def __writeJsonDictToFile(self, jsonDict, filePath):
-        # FIXME: error checking
-        dirPath = path.dirname(filePath)
-        if not path.isdir(dirPath):
-            os.makedirs(dirPath)
+    def __writeJsonFile(self, filePath):
+        """
+        Write the cached dict for filePath to disk.
+        """
+        # Write to a temp file and rename it into place so a partially written
+        # file is never left behind, even if this process dies.  The temp file
+        # is synced first so a crash after the rename cannot leave an empty
+        # file in place of the old one.
+        tmpFilePath = filePath + self.tmpfileSuffix
+        try:
+            with open(tmpFilePath, "wb") as fobj:
+                fobj.write(_dumpJson(self._jsonCache[filePath],
+                                     compact=self._dirtyJsonFiles[filePath],
+                                     nonFinite=(filePath in self._nonFiniteJsonFiles)))
+                fobj.flush()
+                os.fsync(fobj.fileno())
+                statKey = self.__getStatKey(fobj.fileno())
+            os.replace(tmpFilePath, filePath)
+        except BaseException:
+            self.__removeFiles([tmpFilePath])
+            raise
+        self._jsonCacheStatKeys[filePath] = statKey
+
+
+    def __getStatKey(self, fd):
+        """
+        Return a value that changes whenever the file open as fd is modified.
+        Files written by ASVDb are replaced by a new file (inode) on every
+        write, and others writing in place will almost certainly change the
+        size and/or modification time.
+        """
+        st = os.fstat(fd)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
 
-        with open(filePath, "w") as fobj:
-            # FIXME: ideally this could use flock(), but some situations do not
-            # allow grabbing a file lock (NFS?)
-            # fcntl.flock(fobj, fcntl.LOCK_EX)
-            json.dump(jsonDict, fobj, indent=2)
+    def __clearJsonCache(self):
+        """
+        Remove everything from the JSON cache, including unwritten updates.
+        """
+        self._jsonCache.clear()
+        self._jsonCacheStatKeys.clear()
+        self._checkedJsonFiles.clear()
+        self._dirtyJsonFiles.clear()
+        self._nonFiniteJsonFiles.clear()
 
 
     ###########################################################################
     # ASVDb private locking methods
     ###########################################################################
-    def __getLock(self, dirPath):
+    def __getLock(self, dirPath, shared=False):
         """
         Gets a lock on dirPath against other ASVDb instances (in other
-        processes, possibily on other machines) using the following technique:
+        processes, possibily on other machines).  flock() on a file shared by
+        all instances is used if possible: it blocks without polling and the
+        lock is released by the OS if the process dies.  Writers then also
+        take a lockfile (see __getLockfileLock()), since flock() may only lock
+        against this machine (possibly NFS) and instances with useFlock False,
+        or older versions of ASVDb, only use lockfiles.  Since the flock() is
+        held, the lockfile is only contended by those.  If self.useFlock is
+        False or flock() is not supported by the filesystem, only lockfiles
+        are used.
+
+        If shared is True, the lock only excludes writers, so any number of
+        ASVDb instances can read at the same time.  Files are replaced by a
+        rename, so readers would never see a partial file anyway, but the lock
+        ensures a consistent view across all the files read.  Lockfiles do not
+        support this, so they are always exclusive, and shared locks using
+        flock() do not take one.
+
+        Callers must call __releaseLock() even if this raises.
+        """
+        self._threadLock.acquire()
+        if not(shared):
+            if self._dirWriteLock is None:
+                self._dirWriteLock = _getDirWriteLock(dirPath)
+            self._dirWriteLock.acquire()
+            self._holdingDirWriteLock = True
+        if self.useFlock and (fcntl is not None):
+            flockFile = path.join(dirPath, self.flockFileName)
+            # A read-only fd can be locked, so others only need read access.
+            fd = os.open(flockFile, os.O_RDONLY | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            except OSError:
+                os.close(fd)
+                if self.debugPrint:
+                    print(f"Could not flock {flockFile}, using lockfiles")
+            else:
+                if self.debugPrint:
+                    print(f"Locked {flockFile}")
+                self._flockFd = fd
+                if shared:
+                    return
+
+        self._holdingLockfile = True
+        self.__getLockfileLock(dirPath)
+
+
+    def __getLockfileLock(self, dirPath):
+        """
+        Gets a lock on dirPath against other ASVDb instances using lockfiles
+        and the following technique:
 
         * Check for other locks and clear them if they've been seen for longer
           than self.lockfileTimeout (do this to help cleanup after others that
@@ -796,10 +1275,11 @@ class ASVDb:
             # lock, remove this lock and wait a random amount of time before
             # trying again (random time to prevent another race condition with
             # the competing instance, this way someone will clearly get there
-            # first)
+            # first). The max wait doubles on each collision, starting short
+            # since a collision is usually just between two instances.
             if otherLockfileTimes:
-                self.__releaseLock(dirPath)
-                randTime = (int(5 * random.random()) + 1) + random.random()
+                self.__removeFiles([thisLockfile])
+                randTime = random.uniform(0, min(0.05 * (2 ** i), 2))
                 if self.debugPrint:
                     print(f"Collision - waiting {randTime} seconds before "
                           "trying to lock again.")
@@ -811,10 +1291,37 @@ class ASVDb:
 
 
     def __releaseLock(self, dirPath):
-        thisLockfile = path.join(dirPath, self.lockfileName)
-        if self.debugPrint:
-            print(f"Removing lock {thisLockfile}")
-        self.__removeFiles([thisLockfile])
+        try:
+            # Only keep the files used by this operation in the cache, which
+            # keeps the cache small while still covering the common case of
+            # adding results for the same commit/machine repeatedly.
+            for filePath in set(self._jsonCache) - self._checkedJsonFiles:
+                del self._jsonCache[filePath]
+                del self._jsonCacheStatKeys[filePath]
+                self._nonFiniteJsonFiles.discard(filePath)
+            # Each file must be checked again for modification by others once
+            # the lock is released.
+            self._checkedJsonFiles.clear()
+            self._benchmarkParamSets.clear()
+            self._existingDirs.clear()
+            self._paramsResultMaps.clear()
+            if self._holdingLockfile:
+                self._holdingLockfile = False
+                thisLockfile = path.join(dirPath, self.lockfileName)
+                if self.debugPrint:
+                    print(f"Removing lock {thisLockfile}")
+                self.__removeFiles([thisLockfile])
+            if self._flockFd is not None:
+                if self.debugPrint:
+                    print(f"Unlocking {path.join(dirPath, self.flockFileName)}")
+                # Closing the fd releases the flock
+                os.close(self._flockFd)
+                self._flockFd = None
+        finally:
+            if self._holdingDirWriteLock:
+                self._holdingDirWriteLock = False
+                self._dirWriteLock.release()
+            self._threadLock.release()
 
 
     def __updateOtherLockfileTimes(self, dirPath, lockfileTimes):
@@ -829,7 +1336,11 @@ class ASVDb:
         now = time.time()
         expired = []
 
-        allLockfiles = glob.glob(path.join(dirPath, self.lockfilePrefix) + "*")
+        # A plain prefix check on a single dir listing is all that is needed, so
+        # avoid the pattern matching done by glob on every poll.
+        with os.scandir(dirPath) as entries:
+            allLockfiles = [path.join(dirPath, entry.name) for entry in entries
+                            if entry.name.startswith(self.lockfilePrefix)]
 
         if self.debugPrint:
             print(f"   This lockfile is {thisLockfile}, allLockfiles is "
@@ -878,13 +1389,19 @@ class ASVDb:
 
     def __waitForWrite(self):
         """
-        Testing helper: pause for self.writeDelay seconds, or until
-        self.cancelWrite turns True. Always set self.cancelWrite back to False
-        so future writes can take place by default.
+        Testing helper: signal self.writeLockedEvent and wait for
+        self.writeContinueEvent if set, then pause for self.writeDelay seconds,
+        or until self.cancelWrite turns True. Always set self.cancelWrite back
+        to False so future writes can take place by default.
 
         Return True to indicate a write operation should take place, False to
         cancel the write operation, based on if the write was cancelled or not.
         """
+        if self.writeLockedEvent is not None:
+            self.writeLockedEvent.set()
+        if self.writeContinueEvent is not None:
+            self.writeContinueEvent.wait()
+
         if not(self.cancelWrite):
             st = now = time.time()
             while ((now - st) < self.writeDelay) and not(self.cancelWrite):
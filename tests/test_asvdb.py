@@ -1,11 +1,15 @@
+import os
 from os import path
-import tempfile
 import json
+import math
 import threading
-import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import pytest
 
+from asvdb import ASVDb, BenchmarkInfo, BenchmarkResult
+
 datasetName = "dolphins.csv"
 algoRunResults = [('loadDataFile', 3.2228727098554373),
                   ('createGraph', 3.00713360495865345),
@@ -31,8 +35,6 @@ machineName = "my_machine"
 
 
 def createAndPopulateASVDb(dbDir):
-    from asvdb import ASVDb, BenchmarkInfo
-
     db = ASVDb(dbDir, repo, [branch])
     bInfo = BenchmarkInfo(machineName=machineName,
                           cudaVer="9.2",
@@ -49,9 +51,17 @@ def createAndPopulateASVDb(dbDir):
     return addResultsForInfo(db, bInfo)
 
 
-def addResultsForInfo(db, bInfo):
-    from asvdb import ASVDb, BenchmarkResult
+def giveOwnDirWriteLock(db):
+    """
+    ASVDb instances in the same process writing to the same dir normally wait
+    on a shared threading.Lock before taking the file lock.  Give db its own so
+    tests using threads to simulate separate processes test the file lock.
+    """
+    db._dirWriteLock = threading.Lock()
+    return db
+
 
+def addResultsForInfo(db, bInfo):
     for (algoName, exeTime) in algoRunResults:
         bResult = BenchmarkResult(funcName=algoName,
                                   argNameValuePairs=[("dataset", datasetName)],
@@ -61,17 +71,12 @@ def addResultsForInfo(db, bInfo):
     return db
 
 
-def test_addResult():
-    asvDir = tempfile.TemporaryDirectory()
-    db = createAndPopulateASVDb(asvDir.name)
-    asvDir.cleanup()
-
+def test_addResult(tmp_path):
+    db = createAndPopulateASVDb(str(tmp_path))
 
-def test_addResults():
-    asvDir = tempfile.TemporaryDirectory()
-    from asvdb import ASVDb, BenchmarkInfo, BenchmarkResult
 
-    dbDir = asvDir.name
+def test_addResults(tmp_path):
+    dbDir = str(tmp_path)
     db = ASVDb(dbDir, repo, [branch])
     bInfo = BenchmarkInfo(machineName=machineName,
                           cudaVer="9.2",
@@ -102,25 +107,172 @@ def test_addResults():
     assert len(retList[0][1]) == len(algoRunResults)
     assert resultList == retList[0][1]
 
-    asvDir.cleanup()
 
+def test_addResultTuples(tmp_path):
+    dbDir = str(tmp_path)
+    db = ASVDb(dbDir, repo, [branch])
+    bInfo1 = BenchmarkInfo(machineName=machineName,
+                           cudaVer="9.2",
+                           osType="linux",
+                           pythonVer="3.6",
+                           commitHash=commitHash,
+                           commitTime=commitTime)
+    bInfo2 = BenchmarkInfo(machineName=machineName,
+                           cudaVer="10.1",
+                           osType="linux",
+                           pythonVer="3.7",
+                           commitHash=commitHash,
+                           commitTime=commitTime)
+
+    resultList = []
+    for (algoName, exeTime) in algoRunResults:
+        bResult = BenchmarkResult(funcName=algoName,
+                                  argNameValuePairs=[("dataset", datasetName)],
+                                  result=exeTime)
+        resultList.append(bResult)
+
+    db.addResultTuples([(bInfo1, resultList), (bInfo2, resultList)])
+
+    # read back in and check
+    dbCheck = ASVDb(dbDir, repo, [branch])
+    retList = dbCheck.getResults()
+    assert len(retList) == 2
+    for bInfo in [bInfo1, bInfo2]:
+        (_, retResults) = [r for r in retList if r[0] == bInfo][0]
+        assert resultList == retResults
 
-def test_writeWithoutRepoSet():
-    from asvdb import ASVDb
 
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_does_not_exist")
+def test_addResultsInWithBlock(tmp_path):
+    dbDir = str(tmp_path)
+    bInfo = BenchmarkInfo(machineName=machineName, commitHash=commitHash)
+    resultList = [BenchmarkResult(funcName=algoName, result=exeTime)
+                  for (algoName, exeTime) in algoRunResults]
+
+    with ASVDb(dbDir, repo, [branch]) as db:
+        for bResult in resultList:
+            db.addResult(bInfo, bResult)
+        # Nothing is written until the block exits.
+        assert not path.exists(path.join(dbDir, "results"))
+
+    retList = ASVDb(dbDir).getResults()
+    assert len(retList) == 1
+    assert resultList == retList[0][1]
+
+    # Results from a block that raised are discarded.
+    with pytest.raises(RuntimeError):
+        with db:
+            db.addResult(bInfo, BenchmarkResult(funcName="bench", result=1))
+            raise RuntimeError
+    db.flush()
+    assert resultList == ASVDb(dbDir).getResults()[0][1]
+
+    # Only the results from a nested block that raised are discarded.
+    outerResult = BenchmarkResult(funcName="outer", result=2)
+    with db:
+        db.addResult(bInfo, outerResult)
+        with pytest.raises(RuntimeError):
+            with db:
+                db.addResult(bInfo,
+                             BenchmarkResult(funcName="inner", result=3))
+                raise RuntimeError
+    assert resultList + [outerResult] == ASVDb(dbDir).getResults()[0][1]
+
+
+def test_withBlockPerThread(tmp_path):
+    dbDir = str(tmp_path)
+    db = ASVDb(dbDir, repo, [branch])
+    bInfo = BenchmarkInfo(machineName=machineName, commitHash=commitHash)
+    otherThreadResult = BenchmarkResult(funcName="otherThread", result=1)
+
+    # A result added by another thread while this one is in a "with" block is
+    # written right away, and is not discarded when the block raises.
+    with pytest.raises(RuntimeError):
+        with db:
+            db.addResult(bInfo, BenchmarkResult(funcName="inBlock", result=2))
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(db.addResult, bInfo, otherThreadResult).result()
+            assert [otherThreadResult] == ASVDb(dbDir).getResults()[0][1]
+            raise RuntimeError
+    assert [otherThreadResult] == ASVDb(dbDir).getResults()[0][1]
+
+
+def test_autoFlush(tmp_path):
+    dbDir = str(tmp_path)
+    db = ASVDb(dbDir, repo, [branch], autoFlush=False)
+    bInfo = BenchmarkInfo(machineName=machineName, commitHash=commitHash)
+    resultList = [BenchmarkResult(funcName=algoName, result=exeTime)
+                  for (algoName, exeTime) in algoRunResults]
+
+    for bResult in resultList:
+        db.addResult(bInfo, bResult)
+    assert not path.exists(path.join(dbDir, "results"))
+
+    # Results queued before a "with" block that raised are kept.
+    with pytest.raises(RuntimeError):
+        with db:
+            db.addResult(bInfo, BenchmarkResult(funcName="bench", result=1))
+            raise RuntimeError
+
+    db.flush()
+    retList = ASVDb(dbDir).getResults()
+    assert len(retList) == 1
+    assert resultList == retList[0][1]
+
+
+def test_unchangedMachineJsonNotRewritten(tmp_path):
+    dbDir = str(tmp_path)
+    db = ASVDb(dbDir, repo, [branch])
+    bInfo = BenchmarkInfo(machineName=machineName, ram="123456")
+    db.addResult(bInfo, BenchmarkResult(funcName="bench1", result=1))
+
+    # Files are replaced by renaming a new file over them, so an unchanged
+    # inode means the file was not rewritten.
+    machineFile = path.join(dbDir, "results", machineName, "machine.json")
+    origInode = os.stat(machineFile).st_ino
+    db.addResult(bInfo, BenchmarkResult(funcName="bench2", result=2))
+    assert os.stat(machineFile).st_ino == origInode
+
+    bInfo.ram = "654321"
+    db.addResult(bInfo, BenchmarkResult(funcName="bench3", result=3))
+    assert os.stat(machineFile).st_ino != origInode
+    with open(machineFile) as fobj:
+        assert json.load(fobj)["ram"] == "654321"
+
+
+def test_cachedFilesUpdatedByOthers(tmp_path):
+    dbDir = str(tmp_path)
+
+    # db1 caches the files it reads and writes, and must notice that db2
+    # modified them in between.
+    db1 = ASVDb(dbDir, repo, [branch])
+    db2 = ASVDb(dbDir, repo, [branch])
+    bInfo = BenchmarkInfo(machineName=machineName, commitHash=commitHash)
+    bResult1 = BenchmarkResult(funcName="bench1", result=1,
+                               argNameValuePairs=[("arg", 1)])
+    bResult2 = BenchmarkResult(funcName="bench1", result=2,
+                               argNameValuePairs=[("arg", 2)])
+    bResult3 = BenchmarkResult(funcName="bench2", result=3)
+
+    db1.addResult(bInfo, bResult1)
+    db2.addResult(bInfo, bResult2)
+    db1.addResult(bInfo, bResult3)
+
+    results = ASVDb(dbDir).getResults()
+    assert len(results) == 1
+    assert sorted(results[0][1], key=lambda r: r.result) == \
+        [bResult1, bResult2, bResult3]
+
+
+def test_writeWithoutRepoSet(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
 
     db1 = ASVDb(asvDirName)
     with pytest.raises(AttributeError):
         db1.updateConfFile()
 
 
-def test_asvDirDNE():
-    from asvdb import ASVDb
-
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_does_not_exist")
+def test_asvDirDNE(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
     repo = "somerepo"
     branch1 = "branch1"
 
@@ -134,97 +286,107 @@ def test_asvDirDNE():
 
     assert branches == [branch1]
 
-    tmpDir.cleanup()
-
-
-
-def test_newBranch():
-    from asvdb import ASVDb
 
-    asvDir = tempfile.TemporaryDirectory()
+def test_newBranch(tmp_path):
+    dbDir = str(tmp_path)
     repo = "somerepo"
     branch1 = "branch1"
     branch2 = "branch2"
 
-    db1 = ASVDb(asvDir.name, repo, [branch1])
+    db1 = ASVDb(dbDir, repo, [branch1])
     db1.updateConfFile()
-    db2 = ASVDb(asvDir.name, repo, [branch2])
+    db2 = ASVDb(dbDir, repo, [branch2])
     db2.updateConfFile()
 
-    confFile = path.join(asvDir.name, "asv.conf.json")
+    confFile = path.join(dbDir, "asv.conf.json")
     with open(confFile) as fobj:
         j = json.load(fobj)
         branches = j["branches"]
 
     assert branches == [branch1, branch2]
 
-    asvDir.cleanup()
 
+def test_newBranchAfterLoadConfFile(tmp_path):
+    dbDir = str(tmp_path)
+    ASVDb(dbDir, repo, [branch]).updateConfFile()
 
-def test_gitExtension():
-    from asvdb import ASVDb
+    db = ASVDb(dbDir)
+    db.loadConfFile()
+    db.addResult(BenchmarkInfo(machineName=machineName, branch="newbranch"),
+                 BenchmarkResult(funcName="somebenchmark", result=1))
 
-    asvDir = tempfile.TemporaryDirectory()
+    with open(path.join(dbDir, "asv.conf.json")) as fobj:
+        assert json.load(fobj)["branches"] == [branch, "newbranch"]
+
+
+def test_gitExtension(tmp_path):
+    dbDir = str(tmp_path)
     repo = "somerepo"
     branch1 = "branch1"
 
-    db1 = ASVDb(asvDir.name, repo, [branch1])
+    db1 = ASVDb(dbDir, repo, [branch1])
     db1.updateConfFile()
 
-    confFile = path.join(asvDir.name, "asv.conf.json")
+    confFile = path.join(dbDir, "asv.conf.json")
     with open(confFile) as fobj:
         j = json.load(fobj)
         repo = j["repo"]
 
     assert repo.endswith(".git")
 
-    asvDir.cleanup()
-
-
-def test_concurrency():
-    from asvdb import ASVDb, BenchmarkInfo, BenchmarkResult
 
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_does_not_exist")
+# db3UseFlock differing from useFlock checks that writers using flock() and
+# writers only using lockfiles (eg. older versions of asvdb) exclude each other.
+@pytest.mark.parametrize("useFlock,db3UseFlock",
+                         [(True, True), (False, False),
+                          (True, False), (False, True)])
+def test_concurrency(useFlock, db3UseFlock, tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
     repo = "somerepo"
     branch1 = "branch1"
 
     db1 = ASVDb(asvDirName, repo, [branch1])
     db2 = ASVDb(asvDirName, repo, [branch1])
     db3 = ASVDb(asvDirName, repo, [branch1])
-    # Use the writeDelay member var to insert a delay during write to properly
-    # test collisions by making writes slow.
-    db1.writeDelay = 10
-    db2.writeDelay = 10
+    for db in [db1, db2, db3]:
+        db.useFlock = useFlock
+        giveOwnDirWriteLock(db)
+    db3.useFlock = db3UseFlock
+    # Use the write events to hold db1 or db2 in the middle of a write (with
+    # the lock held) to properly test collisions.
+    writeLockedEvent = threading.Event()
+    writeContinueEvent = threading.Event()
+    for db in [db1, db2]:
+        db.writeLockedEvent = writeLockedEvent
+        db.writeContinueEvent = writeContinueEvent
 
     bInfo = BenchmarkInfo()
     bResult1 = BenchmarkResult(funcName="somebenchmark1", result=43)
     bResult2 = BenchmarkResult(funcName="somebenchmark2", result=43)
     bResult3 = BenchmarkResult(funcName="somebenchmark3", result=43)
 
-    # db1 or db2 should be actively writing the result (because the writeDelay is long)
-    # and db3 should be blocked.
-    t1 = threading.Thread(target=db1.addResult, args=(bInfo, bResult1))
-    t2 = threading.Thread(target=db2.addResult, args=(bInfo, bResult2))
-    t3 = threading.Thread(target=db3.addResult, args=(bInfo, bResult3))
-    t1.start()
-    t2.start()
-    time.sleep(0.5)  # ensure t3 tries to write last
-    t3.start()
-
-    # Check that db3 is blocked - if locking wasn't working, it would have
-    # finished since it has no writeDelay.
-    t3.join(timeout=0.5)
-    assert t3.is_alive() is True
-
-    # Cancel db1 and db2, allowing db3 to write and finish
-    db1.cancelWrite = True
-    db2.cancelWrite = True
-    t3.join(timeout=11)
-    assert t3.is_alive() is False
-    t1.join()
-    t2.join()
-    t3.join()
+    # db1 or db2 should be actively writing the result (because it is waiting
+    # on writeContinueEvent) and db3 should be blocked.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        f1 = executor.submit(db1.addResult, bInfo, bResult1)
+        f2 = executor.submit(db2.addResult, bInfo, bResult2)
+        try:
+            assert writeLockedEvent.wait(timeout=10)  # ensure db3 writes last
+            f3 = executor.submit(db3.addResult, bInfo, bResult3)
+
+            # Check that db3 is blocked - if locking wasn't working, it would
+            # have finished since it does not wait on any event.
+            with pytest.raises(TimeoutError):
+                f3.result(timeout=0.5)
+        finally:
+            # Cancel db1 and db2, allowing db3 to write and finish (or the
+            # executor to shut down if the checks above failed)
+            db1.cancelWrite = True
+            db2.cancelWrite = True
+            writeContinueEvent.set()
+        f3.result(timeout=11)
+        f1.result()
+        f2.result()
 
     # Check that db3 wrote its result
     with open(path.join(asvDirName, "results", "benchmarks.json")) as fobj:
@@ -232,40 +394,37 @@ def test_concurrency():
         assert "somebenchmark3" in jo
         #print(jo)
 
-    tmpDir.cleanup()
 
-
-def test_concurrency_stress():
-    from asvdb import ASVDb, BenchmarkInfo, BenchmarkResult
-
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_does_not_exist")
+def test_concurrency_stress(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
     repo = "somerepo"
     branch1 = "branch1"
-    num = 32
+    num = 50
     dbs = []
-    threads = []
+    bResults = []
     allFuncNames = []
 
     bInfo = BenchmarkInfo(machineName=machineName)
 
     for i in range(num):
         db = ASVDb(asvDirName, repo, [branch1])
-        db.writeDelay=0.5
+        # A short delay is enough to make the read-modify-write of each
+        # instance overlap (and lose results) if locking is broken, without
+        # making the serialized writes slow.
+        db.writeDelay = 0.02
+        giveOwnDirWriteLock(db)
         dbs.append(db)
 
         funcName = f"somebenchmark{i}"
-        bResult = BenchmarkResult(funcName=funcName, result=43)
+        bResults.append(BenchmarkResult(funcName=funcName, result=43))
         allFuncNames.append(funcName)
 
-        t = threading.Thread(target=db.addResult, args=(bInfo, bResult))
-        threads.append(t)
-
-    for i in range(num):
-        threads[i].start()
-
-    for i in range(num):
-        threads[i].join()
+    # result() re-raises any exception raised by addResult() in a thread.
+    with ThreadPoolExecutor(max_workers=num) as executor:
+        futures = [executor.submit(db.addResult, bInfo, bResult)
+                   for (db, bResult) in zip(dbs, bResults)]
+        for future in futures:
+            future.result()
 
     # There should be num unique results in the db after (re)reading.  Pick any
     # of the db instances to read, they should all see the same results.
@@ -276,14 +435,94 @@ def test_concurrency_stress():
     allFuncNamesCheck = [r.funcName for r in results[0][1]]
     assert sorted(allFuncNames) == sorted(allFuncNamesCheck)
 
-    tmpDir.cleanup()
+
+def addResultInProcess(asvDirName, useFlock, funcName, barrier):
+    """
+    Worker for test_concurrency_processes, run in a separate process with its
+    own ASVDb instance.
+    """
+    db = ASVDb(asvDirName, repo, [branch])
+    db.useFlock = useFlock
+    db.writeDelay = 0.02
+    bInfo = BenchmarkInfo(machineName=machineName)
+    # Start all writers together, since spawned processes start up at
+    # different times.
+    barrier.wait()
+    db.addResult(bInfo, BenchmarkResult(funcName=funcName, result=43))
+
+
+@pytest.mark.parametrize("useFlock", [True, False])
+def test_concurrency_processes(useFlock, tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
+    num = 3
+    allFuncNames = [f"somebenchmark{i}" for i in range(num)]
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(num)
+    procs = [ctx.Process(target=addResultInProcess,
+                         args=(asvDirName, useFlock, funcName, barrier))
+             for funcName in allFuncNames]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(timeout=60)
+    # Kill any hung worker so a failure does not hang pytest at exit, which
+    # joins all non-daemon child processes.
+    for proc in procs:
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+    assert [proc.exitcode for proc in procs] == [0] * num
+
+    results = ASVDb(asvDirName).getResults()
+    assert sorted(allFuncNames) == sorted(r.funcName for r in results[0][1])
+
+
+def test_concurrencySameInstance(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_does_not_exist")
+    num = 16
+    db = ASVDb(asvDirName, repo, [branch])
+    bInfo = BenchmarkInfo(machineName=machineName)
+    allFuncNames = [f"somebenchmark{i}" for i in range(num)]
+
+    with ThreadPoolExecutor(max_workers=num) as executor:
+        futures = [executor.submit(db.addResult, bInfo,
+                                   BenchmarkResult(funcName=funcName, result=43))
+                   for funcName in allFuncNames]
+        for future in futures:
+            future.result()
+
+    results = ASVDb(asvDirName).getResults()
+    assert sorted(allFuncNames) == sorted(r.funcName for r in results[0][1])
 
 
-def test_read():
-    from asvdb import ASVDb
+def test_readersShareLock(tmp_path):
+    fcntl = pytest.importorskip("fcntl")
+    dbDir = str(tmp_path)
 
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_did_not_exist_before")
+    db = createAndPopulateASVDb(dbDir)
+    bInfo = BenchmarkInfo(machineName=machineName)
+
+    # Hold a shared lock as another reader would: reads can proceed, but
+    # writes must wait until it is released.
+    fd = os.open(path.join(dbDir, ASVDb.flockFileName), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        assert len(ASVDb(dbDir).getResults()) == 1
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(db.addResult, bInfo,
+                                 BenchmarkResult(funcName="bench", result=1))
+        with pytest.raises(TimeoutError):
+            future.result(timeout=0.5)
+    finally:
+        os.close(fd)
+    future.result(timeout=5)
+    executor.shutdown()
+
+
+def test_read(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_did_not_exist_before")
     createAndPopulateASVDb(asvDirName)
 
     db1 = ASVDb(asvDirName)
@@ -314,11 +553,43 @@ def test_read():
     assert br.result == algoRunResults[0][1]
 
 
-def test_getFilteredResults():
-    from asvdb import ASVDb, BenchmarkInfo
-
-    tmpDir = tempfile.TemporaryDirectory()
-    asvDirName = path.join(tmpDir.name, "dir_that_did_not_exist_before")
+def test_readNonFiniteResults(tmp_path):
+    asvDirName = str(tmp_path)
+    db = ASVDb(asvDirName, repo, [branch])
+    bInfo = BenchmarkInfo(machineName=machineName, commitHash=commitHash)
+    db.addResults(bInfo, [BenchmarkResult(funcName="nanBench",
+                                          result=float("nan")),
+                          BenchmarkResult(funcName="infBench",
+                                          result=float("inf"))])
+
+    # NaN and inf are written the same way with or without orjson, and read
+    # back as floats, not None.
+    resultsDir = path.join(asvDirName, "results", machineName)
+    (resultsFileName,) = [f for f in os.listdir(resultsDir)
+                          if f != "machine.json"]
+    with open(path.join(resultsDir, resultsFileName)) as fobj:
+        contents = fobj.read()
+    assert "NaN" in contents
+    assert "Infinity" in contents
+
+    results = {r.funcName: r.result
+               for r in ASVDb(asvDirName).getResults()[0][1]}
+    assert math.isnan(results["nanBench"])
+    assert results["infBench"] == math.inf
+
+    # They are also kept when another instance reads the file in and adds a
+    # finite result.
+    ASVDb(asvDirName, repo, [branch]).addResult(
+        bInfo, BenchmarkResult(funcName="finiteBench", result=1.0))
+    results = {r.funcName: r.result
+               for r in ASVDb(asvDirName).getResults()[0][1]}
+    assert math.isnan(results["nanBench"])
+    assert results["infBench"] == math.inf
+    assert results["finiteBench"] == 1.0
+
+
+def test_getFilteredResults(tmp_path):
+    asvDirName = path.join(str(tmp_path), "dir_that_did_not_exist_before")
 
     db = ASVDb(asvDirName, repo, [branch])
     bInfo1 = BenchmarkInfo(machineName=machineName,
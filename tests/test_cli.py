@@ -0,0 +1,110 @@
+import sys
+
+import pytest
+
+from asvdb import ASVDb, BenchmarkInfo, BenchmarkResult
+from asvdb import __main__ as cli
+
+
+repo = "myrepo"
+branch = "my_branch"
+machineName = "my_machine"
+
+
+def createResultTupleList():
+    bInfo = BenchmarkInfo(machineName=machineName,
+                          commitHash="809a1569e8a2ff138cdde4d9c282328be9dcad43",
+                          branch=branch)
+    return [(bInfo,
+             [BenchmarkResult(funcName="bench1", result=1,
+                              argNameValuePairs=[("dataset", "a.csv")]),
+              BenchmarkResult(funcName="bench2", result=2,
+                              argNameValuePairs=[("dataset", "a.csv")]),
+              BenchmarkResult(funcName="bench3", result=None,
+                              argNameValuePairs=[("dataset", "b.csv")]),
+             ])]
+
+
+def test_filterResults():
+    results = cli.filterResults(createResultTupleList(),
+                                "result is not None and result > 1")
+    assert [r.funcName for r in results[0][1]] == ["bench2"]
+
+    # Members of both objs and builtins can be used in the expression.
+    results = cli.filterResults(createResultTupleList(),
+                                "len(funcName) == 6 and machineName == "
+                                f"'{machineName}' and max(1, 2) == 2")
+    assert len(results[0][1]) == 3
+
+    # A BenchmarkInfo with no results left is dropped.
+    assert cli.filterResults(createResultTupleList(), "False") == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires :=")
+def test_filterResultsWalrus():
+    results = cli.filterResults(createResultTupleList(),
+                                "(r := result) is not None and r < 2")
+    assert [r.funcName for r in results[0][1]] == ["bench1"]
+
+    # Names assigned while evaluating one result are not visible to the next.
+    with pytest.raises(NameError):
+        cli.filterResults(createResultTupleList(),
+                          "(funcName == 'bench1' and (x := 1)) or x")
+
+
+def test_printResults(capsys):
+    resultTupleList = createResultTupleList()
+    assert cli.printResults(resultTupleList,
+                            "funcName, len(argNameValuePairs), result") \
+        is resultTupleList
+    assert capsys.readouterr().out.splitlines() == \
+        ["bench1 1 1", "bench2 1 2", "bench3 1 None"]
+
+
+def test_execResults(tmp_path):
+    dbDir = str(tmp_path)
+    resultTupleList = cli.execResults(
+        createResultTupleList(),
+        "result = -1 if result is None else result * 1000\nunit = 'ms'")
+    assert [(r.result, r.unit) for r in resultTupleList[0][1]] == \
+        [(1000, "ms"), (2000, "ms"), (-1, "ms")]
+
+    # The updated objs are what is written to a db.
+    db = ASVDb(dbDir, repo, [branch])
+    cli.updateDb(db, resultTupleList)
+    results = ASVDb(dbDir).getResults()
+    assert [(r.funcName, r.result) for r in results[0][1]] == \
+        [("bench1", 1000), ("bench2", 2000), ("bench3", -1)]
+
+
+def test_execOnceAndExec():
+    # Vars that are not members of either obj are kept in the global
+    # namespace, so they can be used across results.
+    resultTupleList = cli.execOnce(createResultTupleList(), "numResults = 0")
+    cli.execResults(resultTupleList, "numResults += 1")
+    assert cli.numResults == 3
+
+
+@pytest.mark.parametrize("noThreads", [True, False])
+def test_main(noThreads, tmp_path, monkeypatch):
+    fromDir = str(tmp_path / "from")
+    toDir = str(tmp_path / "to")
+    ASVDb(fromDir, repo, [branch]).addResultTuples(createResultTupleList())
+    ASVDb(toDir, repo, ["otherbranch"]).updateConfFile()
+
+    argv = ["asvdb", "--read-from", fromDir,
+            "--filter", "result is not None",
+            "--exec", "result = result * 2",
+            "--write-to", toDir]
+    if noThreads:
+        argv.append("--no-threads")
+    monkeypatch.setattr(sys, "argv", argv)
+    cli.main()
+
+    toDb = ASVDb(toDir)
+    results = toDb.getResults()
+    assert [(r.funcName, r.result) for r in results[0][1]] == \
+        [("bench1", 2), ("bench2", 4)]
+    # The branches of the db read from are added to the existing db.
+    toDb.loadConfFile()
+    assert toDb.branches == ["otherbranch", branch]